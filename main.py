@@ -1,18 +1,37 @@
 import socket
+import selectors
 import threading
-import pickle
 import enum
+import itertools
 import random
 import math
 import time
 import sys
+import struct
+from typing import List, Optional, Tuple, Union
+import msgspec
+import numpy as np
 import pygame
 
+try:
+    import fcntl
+    import termios
+except ImportError:
+    fcntl = None
 
-BUFFER_SIZE = 4096
 
+BUFFER_SIZE = 64 * 1024
+SOCKET_BUFFER_SIZE = 64 * 1024
+MAX_QUEUED_BYTES = 1024 * 1024
+MAX_FRAME_SIZE = MAX_QUEUED_BYTES
+RESYNC_INTERVAL = 2
+TICK_INTERVAL = 1 / 60
+SPRITE_ANGLE_STEP = 5
+BULLET_RANGE = 500
+MIN_SPEED = 0.01
 
-class MessageType(enum.Enum):
+
+class MessageType(enum.IntEnum):
     GAME_INFO_REQUEST = 0
     GAME_INFO_SEND = 1
     PLAYER_INFO_BROADCAST = 2
@@ -20,6 +39,28 @@ class MessageType(enum.Enum):
     NEW_PLAYER_INFO = 4
 
 
+class PlayerState(enum.IntEnum):
+    CURRENT = 0
+    ONLINE = 1
+    OFFLINE = 2
+    DEAD = 3
+
+
+PLAYER_COLORS = {
+    PlayerState.CURRENT: (255, 0, 0),
+    PlayerState.ONLINE: (0, 0, 255),
+    PlayerState.OFFLINE: (96, 96, 96),
+    PlayerState.DEAD: (50, 50, 50)
+}
+
+KEY_MAP = {
+    pygame.K_a: 'control_left',
+    pygame.K_d: 'control_right',
+    pygame.K_w: 'control_up',
+    pygame.K_s: 'control_down'
+}
+
+
 class Timer:
     def __init__(self, start=False):
         self.paused = not start
@@ -49,17 +90,163 @@ class Timer:
         self.__time_point = time.time()
 
 
-class Message:
-    def __init__(self, type, data=None):
-        self.type = type
-        self.data = data
+class PlayerInfo(msgspec.Struct, tag=True, omit_defaults=True):
+    id: int
+    position: Optional[Tuple[float, float]] = None
+    velocity: Optional[Tuple[float, float]] = None
+    angle: Optional[float] = None
+    state: Optional[PlayerState] = None
+    attacking: Optional[bool] = None
 
 
-class PlayerState(enum.Enum):
-    CURRENT = 0
-    ONLINE = 1
-    OFFLINE = 2
-    DEAD = 3
+class BulletInfo(msgspec.Struct, omit_defaults=True):
+    id: int
+    position: Optional[Tuple[float, float]] = None
+    velocity: Optional[Tuple[float, float]] = None
+    angle: Optional[float] = None
+    destroyed: Optional[bool] = None
+    owner_id: Optional[int] = None
+
+
+class GameInfo(msgspec.Struct, tag=True):
+    players: List[PlayerInfo]
+    bullets: List[BulletInfo]
+
+
+class MessageEnv(msgspec.Struct, array_like=True):
+    type: MessageType
+    data: Union[PlayerInfo, GameInfo, None] = None
+
+
+encoder = msgspec.msgpack.Encoder()
+decoder = msgspec.msgpack.Decoder(MessageEnv)
+
+
+def angle_bucket(angle):
+    return int(angle) % 360 // SPRITE_ANGLE_STEP
+
+
+def set_buffer_sizes(sock):
+    # The window scale is negotiated during the handshake, so this has to
+    # happen before connect() or listen(); accepted sockets inherit it
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+
+
+def disable_nagle(sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def quickack(sock):
+    # Linux re-enables delayed ACKs after every read
+    if hasattr(socket, 'TCP_QUICKACK'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+
+
+def queued_bytes(sock):
+    if fcntl is None:
+        return 0
+    data = fcntl.ioctl(sock.fileno(), termios.FIONREAD, struct.pack("i", 0))
+    return struct.unpack("i", data)[0]
+
+
+def send_msg(sock, payload):
+    sock.sendall(struct.pack(">I", len(payload)) + payload)
+
+
+def send_frame(sock, frame):
+    # Gathered write of an already built (header, payload) pair to a
+    # non-blocking socket, returning how much of it was taken; Windows has
+    # no sendmsg
+    try:
+        if hasattr(sock, 'sendmsg'):
+            return sock.sendmsg(frame)
+        return sock.send(b''.join(frame))
+    except BlockingIOError:
+        return 0
+
+
+def recv_exact(sock, n):
+    data = bytearray(n)
+    view = memoryview(data)
+    received = 0
+    while received < n:
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise ConnectionResetError("Connection closed by peer")
+        quickack(sock)
+        received += count
+    return data
+
+
+def check_frame_size(length):
+    # The length comes from the peer, so it must not decide on its own how
+    # much memory is allocated for the frame
+    if length > MAX_FRAME_SIZE:
+        raise ConnectionError("Frame of {} bytes is too large".format(length))
+
+
+def recv_msg(sock):
+    length, = struct.unpack(">I", recv_exact(sock, 4))
+    check_frame_size(length)
+    return recv_exact(sock, length)
+
+
+class FrameReader:
+    # Receives into one persistent buffer and decodes complete frames
+    # straight from views of it, so reads allocate no intermediate bytes
+
+    def __init__(self, size=BUFFER_SIZE):
+        self._rxbuf = bytearray(size)
+        self._rxview = memoryview(self._rxbuf)
+        self._rxlen = 0
+
+    def read(self, sock):
+        free = len(self._rxbuf) - self._rxlen
+        count = sock.recv_into(self._rxview[self._rxlen:])
+        if not count:
+            raise ConnectionResetError("Connection closed by peer")
+        quickack(sock)
+        self._rxlen += count
+
+        if count == free:
+            # The buffer filled up, so more is likely queued; make room for
+            # all of it and drain it with a single read
+            queued = queued_bytes(sock)
+            if queued:
+                if self._rxlen + queued > len(self._rxbuf):
+                    self._grow(self._rxlen + queued)
+                view = self._rxview[self._rxlen:]
+                self._rxlen += sock.recv_into(view, queued)
+
+        messages = []
+        start = 0
+        while self._rxlen - start >= 4:
+            length, = struct.unpack_from(">I", self._rxbuf, start)
+            end = start + 4 + length
+            if end > self._rxlen:
+                break
+            messages.append(decoder.decode(self._rxview[start + 4:end]))
+            start = end
+
+        remaining = self._rxlen - start
+        if start:
+            self._rxview[:remaining] = self._rxview[start:self._rxlen]
+        self._rxlen = remaining
+
+        if remaining >= 4:
+            length, = struct.unpack_from(">I", self._rxbuf)
+            check_frame_size(length)
+            if 4 + length > len(self._rxbuf):
+                self._grow(4 + length)
+        return messages
+
+    def _grow(self, size):
+        rxbuf = bytearray(size)
+        rxbuf[:self._rxlen] = self._rxview[:self._rxlen]
+        self._rxview.release()
+        self._rxbuf = rxbuf
+        self._rxview = memoryview(self._rxbuf)
 
 
 class PlayerConnection:
@@ -67,8 +254,36 @@ class PlayerConnection:
         self.sock = sock
         self.address = addr
         self.player = player
+        self.reader = FrameReader()
+        self.outbox = bytearray()
+        self.synced_tick = None
+        self.resync_timer = Timer(start=True)
         self.__active = True
 
+    def receive(self):
+        return self.reader.read(self.sock)
+
+    def send(self, frame):
+        # Whatever the socket does not take right away is queued behind
+        # what is already waiting and written by flush()
+        if self.outbox:
+            self.outbox += frame[0]
+            self.outbox += frame[1]
+        else:
+            sent = send_frame(self.sock, frame)
+            if sent < len(frame[0]) + len(frame[1]):
+                self.outbox += b''.join(frame)[sent:]
+
+        if len(self.outbox) > MAX_QUEUED_BYTES:
+            raise ConnectionError("Client is not reading")
+
+    def flush(self):
+        try:
+            sent = self.sock.send(self.outbox)
+        except BlockingIOError:
+            return
+        del self.outbox[:sent]
+
     def disconnect(self):
         self.sock.close()
         self.player.state = PlayerState.OFFLINE
@@ -78,77 +293,251 @@ class PlayerConnection:
         return self.__active
 
 
-class Bullet:
-    def __init__(self,
-                 owner_id,
-                 position=pygame.math.Vector2(),
-                 velocity=pygame.math.Vector2(),
-                 angle=0):
-        self.owner_id = owner_id
-        self.position = pygame.math.Vector2(position)
-        self.velocity = pygame.math.Vector2(velocity)
-        self.angle = angle
+class SyncedField:
+    # Attribute that remembers on its entity that it was assigned a new
+    # value, so changes are recorded where they are made
 
-        self.speed = 5
-        self.rect = pygame.Rect(self.position[0], self.position[1], 5, 5)
-        self.destroyed = False
-        self.start_position = pygame.math.Vector2(self.position)
+    def __set_name__(self, owner, name):
+        self.name = name
+        owner.synced_fields = owner.synced_fields + (name,)
 
-    def traveled_distance(self):
-        vector = self.start_position - self.position
-        distance = (vector[0] ** 2 + vector[1] ** 2) ** 0.5
-        return distance
+    def __get__(self, entity, owner=None):
+        if entity is None:
+            return self
+        return entity.__dict__[self.name]
 
-    def update(self, game):
-        self.position += self.velocity
-        self.rect = pygame.Rect(self.position[0], self.position[1], 5, 5)
+    def __set__(self, entity, value):
+        if entity.__dict__.get(self.name, self) != value:
+            entity.__dict__[self.name] = value
+            entity._dirty.add(self.name)
 
-        if self.traveled_distance() > 500:
-            self.destroyed = True
 
-        players = [p for p in game.players if p.id != self.owner_id]
+class Entity:
+    synced_fields = ()
 
-        for player in players:
-            if self.rect.colliderect(player.rect):
-                player.state = PlayerState.DEAD
-                player.velocity += self.velocity / 2
-                self.destroyed = True
+    def __init__(self):
+        self._position = np.zeros(2, dtype=np.float32)
+        self._velocity = np.zeros(2, dtype=np.float32)
+        self._moved = np.zeros(2, dtype=np.int64)
+        self._dirty = set()
+        self._changed = {}
+
+    @property
+    def position(self):
+        return self._position
+
+    @position.setter
+    def position(self, value):
+        self._position[:] = value
+
+    @property
+    def velocity(self):
+        return self._velocity
+
+    @velocity.setter
+    def velocity(self, value):
+        self._velocity[:] = value
+
+    def bind(self, arrays, index):
+        self._position = arrays.position[index]
+        self._velocity = arrays.velocity[index]
+        self._moved = arrays.moved[index]
+
+    def mark_changes(self, tick):
+        if self._dirty:
+            for name in self._dirty:
+                self._changed[name] = tick
+            self._dirty.clear()
+
+    def changed_since(self, since):
+        return (since is None or self._moved.max() > since or
+                any(tick > since for tick in self._changed.values()))
+
+    def changed_fields(self, since=None):
+        # Position and velocity are tracked by EntityArrays, the remaining
+        # fields by SyncedField
+        fields = {}
+        if since is None or self._moved[0] > since:
+            fields['position'] = tuple(self.position.tolist())
+        if since is None or self._moved[1] > since:
+            fields['velocity'] = tuple(self.velocity.tolist())
+        for name in self.synced_fields:
+            if since is None or self._changed.get(name, 0) > since:
+                fields[name] = getattr(self, name)
+        return fields
+
+
+class EntityArrays:
+    # Positions and velocities of all entities of one kind live in shared
+    # arrays so that movement is applied to every entity at once; each
+    # entity is bound to views of its own rows. The position an entity was
+    # added at is kept alongside for range checks, and the values seen by
+    # the last mark_changes() for finding the rows that moved since
+    columns = (('position', np.float32),
+               ('velocity', np.float32),
+               ('start', np.float32),
+               ('marked_position', np.float32),
+               ('marked_velocity', np.float32),
+               ('moved', np.int64))
+
+    def __init__(self, capacity=16):
+        self.entities = []
+        self._by_id = {}
+        for name, dtype in self.columns:
+            setattr(self, name, np.zeros((capacity, 2), dtype=dtype))
+
+    def __iter__(self):
+        return iter(self.entities)
+
+    def __len__(self):
+        return len(self.entities)
+
+    def get(self, id):
+        return self._by_id.get(id)
+
+    def bind_all(self, first=0):
+        for index in range(first, len(self.entities)):
+            self.entities[index].bind(self, index)
+
+    def add(self, entity):
+        index = len(self.entities)
+        if index == len(self.position):
+            for name, _ in self.columns:
+                column = getattr(self, name)
+                setattr(self, name,
+                        np.concatenate((column, np.zeros_like(column))))
+            self.bind_all()
+
+        self.position[index] = entity.position
+        self.velocity[index] = entity.velocity
+        self.start[index] = entity.position
+        # Nothing compares equal to NaN, so the next mark sees a new row
+        self.marked_position[index] = np.nan
+        self.marked_velocity[index] = np.nan
+        self.moved[index] = 0
+        self.entities.append(entity)
+        self._by_id[entity.id] = entity
+        entity.bind(self, index)
+
+    def retain(self, keep):
+        keep = np.array(keep, dtype=bool)
+        if keep.all():
+            return
+
+        # Rows before the first removed one stay where they are
+        first = int(np.argmin(keep))
+        count = len(self.entities)
+        kept = int(keep.sum())
+        for name, _ in self.columns:
+            column = getattr(self, name)
+            column[first:kept] = column[first:count][keep[first:]]
+
+        for entity, k in zip(self.entities[first:], keep[first:]):
+            if not k:
+                del self._by_id[entity.id]
+        self.entities = [e for e, k in zip(self.entities, keep) if k]
+        self.bind_all(first)
+
+    def mark_changes(self, tick):
+        count = len(self.entities)
+        for column, current, marked in (
+                (0, self.position, self.marked_position),
+                (1, self.velocity, self.marked_velocity)):
+            moved = (current[:count] != marked[:count]).any(axis=1)
+            self.moved[:count, column][moved] = tick
+            marked[:count] = current[:count]
+
+        for entity in self.entities:
+            entity.mark_changes(tick)
+
+    def traveled_beyond(self, distance):
+        count = len(self.entities)
+        traveled = self.position[:count] - self.start[:count]
+        return (traveled ** 2).sum(axis=1) > distance * distance
+
+    def move(self):
+        count = len(self.entities)
+        self.position[:count] += self.velocity[:count]
+
+
+class Bullet(Entity):
+    speed = 5
+    _base_surface = pygame.Surface((5, 5), pygame.SRCALPHA, 32)
+    _base_surface.fill((255, 0, 255))
+    _sprite_cache = {}
+
+    def __init__(self,
+                 id,
+                 owner_id,
+                 position=None,
+                 velocity=None,
+                 angle=0,
+                 fired_tick=0):
+        super().__init__()
+        self.id = id
+        self.owner_id = owner_id
+        if position is not None:
+            self.position = position
+        if velocity is not None:
+            self.velocity = velocity
+        self.angle = angle
+        self.destroyed = False
+        self.fired_tick = fired_tick
 
     def draw(self, surface):
-        size = (5, 5)
-        image = pygame.Surface(size, pygame.SRCALPHA, 32)
-        image.fill((255, 0, 255))
-        image = pygame.transform.rotate(image, self.angle)
-        surface.blit(image, (self.position[0] - image.get_size()[0] / 2,
-                             self.position[1] - image.get_size()[1] / 2))
-
-    def dump_info(self):
-        info = {
-            'position': self.position,
-            'velocity': self.velocity,
-            'angle': self.angle,
-            'destroyed': self.destroyed,
-            'owner_id': self.owner_id
-        }
+        key = angle_bucket(self.angle)
+        image = self._sprite_cache.get(key)
+        if image is None:
+            image = pygame.transform.rotate(self._base_surface,
+                                            key * SPRITE_ANGLE_STEP)
+            image = image.convert_alpha()
+            self._sprite_cache[key] = image
+
+        x, y = self.position.tolist()
+        surface.blit(image, (x - image.get_size()[0] / 2,
+                             y - image.get_size()[1] / 2))
+
+    def dump_info(self, since=None):
+        # Bullets move every tick, so their position is always sent; the
+        # other fields do not change after the bullet was fired
+        info = BulletInfo(id=self.id, position=tuple(self.position.tolist()))
+        if since is None or self.fired_tick > since:
+            info.velocity = tuple(self.velocity.tolist())
+            info.angle = self.angle
+            info.destroyed = self.destroyed
+            info.owner_id = self.owner_id
         return info
 
     def load_info(self, info):
-        self.position = info['position']
-        self.velocity = info['velocity']
-        self.angle = info['angle']
-        self.destroyed = info['destroyed']
-        self.owner_id = info['owner_id']
+        self.id = info.id
+        if info.position is not None:
+            self.position = info.position
+        if info.velocity is not None:
+            self.velocity = info.velocity
+        if info.angle is not None:
+            self.angle = info.angle
+        if info.destroyed is not None:
+            self.destroyed = info.destroyed
+        if info.owner_id is not None:
+            self.owner_id = info.owner_id
+
+
+class Player(Entity):
+    damping = 0.9
+    _sprite_cache = {}
+
+    angle = SyncedField()
+    state = SyncedField()
+    attacking = SyncedField()
 
-
-class Player:
     def __init__(self, id):
+        super().__init__()
         self.id = id
-        self.position = pygame.math.Vector2(0, 0)
-        self.velocity = pygame.math.Vector2(0, 0)
+        self.position = (0, 0)
+        self.velocity = (0, 0)
         self.angle = 0
         self.speed = 2
         self.state = PlayerState.ONLINE
-        self.rect = pygame.Rect(self.position[0], self.position[1], 32, 32)
 
         self.control_left = False
         self.control_right = False
@@ -161,9 +550,6 @@ class Player:
         self.attack_timer = Timer()
 
     def update(self, game):
-        self.position += self.velocity
-        self.rect.center = self.position
-        self.velocity *= 0.9
         self.attack_timer.update()
 
         if self.attack_timer.time_elapsed > self.attack_cooldown:
@@ -186,44 +572,42 @@ class Player:
             self.velocity[1] = self.speed
 
 
-    def draw(self, surface, pivot):
-        if self.state == PlayerState.CURRENT:
-            color = (255, 0, 0)
-        elif self.state == PlayerState.ONLINE:
-            color = (0, 0, 255)
-        elif self.state == PlayerState.OFFLINE:
-            color = (96, 96, 96)
-        elif self.state == PlayerState.DEAD:
-            color = (50, 50, 50)
-        image = pygame.Surface((32, 32), pygame.SRCALPHA, 32)
-        image.fill(color=color)
+    def draw(self, surface, pivot, position=None):
+        key = (self.state, angle_bucket(self.angle))
+        image = self._sprite_cache.get(key)
+        if image is None:
+            image = pygame.Surface((32, 32), pygame.SRCALPHA, 32)
+            image.fill(color=PLAYER_COLORS[self.state])
+            image = pygame.transform.rotate(image, key[1] * SPRITE_ANGLE_STEP)
+            image = image.convert_alpha()
+            self._sprite_cache[key] = image
 
         #screen_center = pygame.math.Vector2(surface.get_size()) / 2
         #vector = self.position - pivot
         #relative_position = screen_center + vector
 
-        image = pygame.transform.rotate(image, self.angle)
-        surface.blit(image, (self.position[0] - image.get_size()[0] / 2,
-                             self.position[1] - image.get_size()[1] / 2))
-
-    def dump_info(self):
-        info = {
-            'id': self.id,
-            'position': self.position,
-            'velocity': self.velocity,
-            'angle': self.angle,
-            'state': self.state,
-            'attacking': self.attacking
-        }
+        if position is None:
+            position = self.position
+        x, y = position.tolist()
+        surface.blit(image, (x - image.get_size()[0] / 2,
+                             y - image.get_size()[1] / 2))
+
+    def dump_info(self, since=None):
+        info = PlayerInfo(id=self.id, **self.changed_fields(since))
         return info
 
     def load_info(self, info):
-        self.id = info['id']
-        self.position = info['position']
-        self.velocity = info['velocity']
-        self.angle = info['angle']
-        self.state = info['state']
-        self.attacking = info['attacking']
+        self.id = info.id
+        if info.position is not None:
+            self.position = info.position
+        if info.velocity is not None:
+            self.velocity = info.velocity
+        if info.angle is not None:
+            self.angle = info.angle
+        if info.state is not None:
+            self.state = info.state
+        if info.attacking is not None:
+            self.attacking = info.attacking
 
     def turn_to(self, point):
         rel_x, rel_y = point - self.position
@@ -231,24 +615,10 @@ class Player:
 
     def control(self, event):
         if self.state != PlayerState.DEAD:
-            if event.type == pygame.KEYDOWN:
-                if event.key == ord('a'):
-                    self.control_left = True
-                elif event.key == ord('d'):
-                    self.control_right = True
-                elif event.key == ord('w'):
-                    self.control_up = True
-                elif event.key == ord('s'):
-                    self.control_down = True
-            elif event.type == pygame.KEYUP:
-                if event.key == ord('a'):
-                    self.control_left = False
-                elif event.key == ord('d'):
-                    self.control_right = False
-                elif event.key == ord('w'):
-                    self.control_up = False
-                elif event.key == ord('s'):
-                    self.control_down = False
+            if event.type in (pygame.KEYDOWN, pygame.KEYUP):
+                attr = KEY_MAP.get(event.key)
+                if attr:
+                    setattr(self, attr, event.type == pygame.KEYDOWN)
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 self.control_lmbutton = True
             elif event.type == pygame.MOUSEBUTTONUP:
@@ -257,52 +627,111 @@ class Player:
 
 class Game:
     def __init__(self):
-        self.players = []
-        self.bullets = []
-
-    def update(self):
-        for player in self.players:
-            player.update(self)
+        self.players = EntityArrays()
+        self.bullets = EntityArrays()
+        self.bullet_ids = itertools.count()
+        self.tick = 0
 
-        for bullet in self.bullets:
-            bullet.update(self)
+        self.local_player = None
+        self.previous_positions = np.zeros((0, 2), dtype=np.float32)
+        self.snapshot_time = time.perf_counter()
 
-        self.bullets = [b for b in self.bullets if not b.destroyed]
+    def update(self):
+        # Players are moved by their own clients, which report where they
+        # are; the knockback of a hit is handed to the client through the
+        # player's velocity
+        self.bullets.move()
+        self.collide_bullets()
+
+        destroyed = np.array([b.destroyed for b in self.bullets], dtype=bool)
+        destroyed |= self.bullets.traveled_beyond(BULLET_RANGE)
+        self.bullets.retain(~destroyed)
+
+        self.tick += 1
+        self.players.mark_changes(self.tick)
+
+    def collide_bullets(self):
+        bullet_count = len(self.bullets)
+        player_count = len(self.players)
+        if not bullet_count or not player_count:
+            return
+
+        # Distance between the centres of the 5x5 bullet boxes (anchored at
+        # their top-left corner) and the centred 32x32 player boxes, tested
+        # against the sum of their half sizes
+        offset = (self.bullets.position[:bullet_count, None] + 2.5 -
+                  self.players.position[None, :player_count])
+        hit = (np.abs(offset) < 18.5).all(axis=2)
+
+        owner_ids = np.array([b.owner_id for b in self.bullets])
+        player_ids = np.array([p.id for p in self.players])
+        hit &= owner_ids[:, None] != player_ids[None, :]
+
+        for bullet_index, player_index in zip(*np.nonzero(hit)):
+            bullet = self.bullets.entities[bullet_index]
+            player = self.players.entities[player_index]
+            player.state = PlayerState.DEAD
+            player.velocity += bullet.velocity / 2
+            bullet.destroyed = True
+
+    def interpolated_positions(self):
+        # Players are never removed, so the rows of the previous snapshot
+        # line up with the current ones; players that joined since then
+        # are drawn where they are
+        count = len(self.players)
+        current = self.players.position[:count]
+        previous = current.copy()
+        known = min(count, len(self.previous_positions))
+        previous[:known] = self.previous_positions[:known]
+
+        elapsed = time.perf_counter() - self.snapshot_time
+        alpha = min(1, elapsed / TICK_INTERVAL)
+        return previous + (current - previous) * alpha
 
     def draw(self, surface, center):
         surface.fill((30, 30, 30))
 
-        for player in self.players:
-            player.draw(surface, center)
+        positions = self.interpolated_positions()
+        for player, position in zip(self.players, positions):
+            if player is self.local_player:
+                position = None
+            player.draw(surface, center, position)
 
         for bullet in self.bullets:
             bullet.draw(surface)
 
-    def dump_info(self):
-        info = {
-            'players': [p.dump_info() for p in self.players],
-            'bullets': [b.dump_info() for b in self.bullets],
-        }
+    def dump_info(self, since=None):
+        # Players are only sent when they changed, bullets always are so
+        # that the receiver can drop the ones which are gone
+        info = GameInfo(players=[p.dump_info(since) for p in self.players
+                                 if p.changed_since(since)],
+                        bullets=[b.dump_info(since) for b in self.bullets])
         return info
 
     def load_info(self, info):
-        for pi in info['players']:
-            player_exists = False
-            for p in self.players:
-                if p.id == pi['id']:
-                    player_exists = True
-                    p.load_info(pi)
-                    break
-            if not player_exists:
-                player = Player(len(self.players))
+        count = len(self.players)
+        self.previous_positions = self.players.position[:count].copy()
+        self.snapshot_time = time.perf_counter()
+
+        for pi in info.players:
+            player = self.players.get(pi.id)
+            if player is None:
+                player = Player(pi.id)
+                player.load_info(pi)
+                self.players.add(player)
+            else:
                 player.load_info(pi)
-                self.players.append(player)
 
-        self.bullets = []
-        for bi in info['bullets']:
-            b = Bullet(bi['owner_id'])
-            b.load_info(bi)
-            self.bullets.append(b)
+        bullet_ids = {bi.id for bi in info.bullets}
+        self.bullets.retain([b.id in bullet_ids for b in self.bullets])
+        for bi in info.bullets:
+            b = self.bullets.get(bi.id)
+            if b is None:
+                b = Bullet(bi.id, bi.owner_id)
+                b.load_info(bi)
+                self.bullets.add(b)
+            else:
+                b.load_info(bi)
 
 
 class GameServer:
@@ -311,97 +740,178 @@ class GameServer:
         self.connections = []
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        set_buffer_sizes(self.server_socket)
         self.server_socket.bind(server_address)
         self.server_socket.listen(1)
+        self.server_socket.setblocking(False)
 
-        threading.Thread(target=self.accept_clients).start()
-
-    def accept_clients(self):
-        while True:
-            sock, address = self.server_socket.accept()
-            print("Client {} connected.".format(address))
-            player = Player(len(self.connections))
-            self.connections.append(PlayerConnection(sock, address, player))
-            self.game.players.append(player)
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(self.server_socket, selectors.EVENT_READ)
 
-            player.position = pygame.math.Vector2(random.randint(0, 400),
-                                                  random.randint(0, 300))
-
-            player_info = player.dump_info()
-            message = Message(MessageType.NEW_PLAYER_INFO, player_info)
-            data = pickle.dumps(message)
+        self._handlers = {
+            MessageType.GAME_INFO_REQUEST: self._on_game_info_request,
+            MessageType.PLAYER_INFO: self._on_player_info
+        }
 
-            sock.sendall(data)
+    def accept_clients_step(self):
+        sock, address = self.server_socket.accept()
+        disable_nagle(sock)
+        print("Client {} connected.".format(address))
+        player = Player(len(self.connections))
+        player_conn = PlayerConnection(sock, address, player)
+        self.connections.append(player_conn)
+        self.game.players.add(player)
+
+        player.position = (random.randint(0, 400), random.randint(0, 300))
+
+        player_info = player.dump_info()
+        message = MessageEnv(MessageType.NEW_PLAYER_INFO, player_info)
+        data = encoder.encode(message)
+
+        send_msg(sock, data)
+
+        sock.setblocking(False)
+        self.sel.register(sock, selectors.EVENT_READ, player_conn)
+
+    def handle_client_read(self, player_conn):
+        try:
+            for message in player_conn.receive():
+                self.handle_message(player_conn, message)
+        except (OSError, msgspec.DecodeError):
+            self.disconnect(player_conn)
+
+    def handle_client_write(self, player_conn):
+        try:
+            player_conn.flush()
+        except OSError:
+            self.disconnect(player_conn)
+            return
+
+        if not player_conn.outbox:
+            self.sel.modify(player_conn.sock, selectors.EVENT_READ,
+                            player_conn)
+
+    def send(self, player_conn, frame):
+        queued = bool(player_conn.outbox)
+        try:
+            player_conn.send(frame)
+        except OSError:
+            self.disconnect(player_conn)
+            return
+
+        if player_conn.outbox and not queued:
+            self.sel.modify(player_conn.sock,
+                            selectors.EVENT_READ | selectors.EVENT_WRITE,
+                            player_conn)
+
+    def disconnect(self, player_conn):
+        print("Client {} disconnected.".format(player_conn.address))
+        self.sel.unregister(player_conn.sock)
+        player_conn.disconnect()
+
+    def broadcast_game_info(self):
+        # Clients that are in sync share a delta, so each distinct
+        # snapshot is encoded only once per tick
+        frames = {}
+        for player_conn in [c for c in self.connections if c.is_active()]:
+            player_conn.resync_timer.update()
+            if player_conn.resync_timer.time_elapsed > RESYNC_INTERVAL:
+                player_conn.resync_timer.reset()
+                player_conn.synced_tick = None
+
+            since = player_conn.synced_tick
+            if since not in frames:
+                game_info = self.game.dump_info(since=since)
+                message = MessageEnv(MessageType.GAME_INFO_SEND, game_info)
+                payload = encoder.encode(message)
+                frames[since] = (struct.pack(">I", len(payload)), payload)
+            player_conn.synced_tick = self.game.tick
+            self.send(player_conn, frames[since])
 
     def handle_message(self, player_conn, message):
-        if message.type == MessageType.GAME_INFO_REQUEST:
-            game_info = self.game.dump_info()
-            message = Message(MessageType.GAME_INFO_SEND, game_info)
-            data = pickle.dumps(message)
-            player_conn.sock.sendall(data)
-        elif message.type == MessageType.PLAYER_INFO:
-            player_info = message.data
-
-            if player_info['attacking']:
-                bullet = Bullet(player_info['id'])
-
-                angle = player_info['angle'] - 270
-                angle_radians = math.radians(angle)
-                velocity = pygame.math.Vector2(math.sin(angle_radians),
-                                               math.cos(angle_radians))
-                velocity *= bullet.speed
-
-                position = player_info['position'] + velocity
-                bullet = Bullet(owner_id=player_info['id'],
-                                position=position,
-                                velocity=velocity,
-                                angle=angle)
-
-                self.game.bullets.append(bullet)
-
-            for player in self.game.players:
-                if player.state == PlayerState.CURRENT:
-                    player.state = PlayerState.ONLINE
-                if player.id == player_info['id']:
-                    player.load_info(player_info)
-
-            game_info = self.game.dump_info()
-            message = Message(MessageType.GAME_INFO_SEND, game_info)
-            data = pickle.dumps(message)
-            player_conn.sock.sendall(data)
+        handler = self._handlers.get(message.type)
+        if handler is not None:
+            handler(player_conn, message.data)
+
+    def _on_game_info_request(self, player_conn, data):
+        player_conn.synced_tick = None
+
+    def _on_player_info(self, player_conn, player_info):
+        if not isinstance(player_info, PlayerInfo):
+            raise ConnectionError("Expected player info")
+
+        # A client only ever updates its own player. Whether a player is
+        # online or dead is decided here, CURRENT only means something to
+        # the client that owns the player
+        player = player_conn.player
+        player_info.id = player.id
+        player_info.state = None
+        player.load_info(player_info)
+
+        if player_info.attacking:
+            angle = player.angle - 270
+            angle_radians = math.radians(angle)
+            velocity = (math.sin(angle_radians) * Bullet.speed,
+                        math.cos(angle_radians) * Bullet.speed)
+
+            x, y = player.position.tolist()
+            position = (x + velocity[0], y + velocity[1])
+            bullet = Bullet(id=next(self.game.bullet_ids),
+                            owner_id=player.id,
+                            position=position,
+                            velocity=velocity,
+                            angle=angle,
+                            fired_tick=self.game.tick + 1)
+
+            self.game.bullets.add(bullet)
 
     def loop(self):
+        next_tick = time.perf_counter()
         while True:
-            self.game.update()
+            timeout = max(0, next_tick - time.perf_counter())
+            for key, events in self.sel.select(timeout=timeout):
+                if key.fileobj is self.server_socket:
+                    self.accept_clients_step()
+                    continue
+
+                if events & selectors.EVENT_WRITE:
+                    self.handle_client_write(key.data)
+                if events & selectors.EVENT_READ and key.data.is_active():
+                    self.handle_client_read(key.data)
 
-            for conn in [c for c in self.connections if c.is_active()]:
-                try:
-                    data = conn.sock.recv(BUFFER_SIZE)
-                    message = pickle.loads(data)
-                    self.handle_message(conn, message)
-                except pickle.UnpicklingError:
-                    pass
-                except ConnectionResetError:
-                    print("Client {} disconnected.".format(conn.address))
-                    conn.disconnect()
+            if time.perf_counter() >= next_tick:
+                self.game.update()
+                self.broadcast_game_info()
+                next_tick += TICK_INTERVAL
 
 
 class GameClient:
     def __init__(self, server_address):
         self.player = None
+        self._handlers = {
+            MessageType.NEW_PLAYER_INFO: self._on_new_player_info,
+            MessageType.GAME_INFO_SEND: self._on_game_info_send
+        }
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        set_buffer_sizes(self.client_socket)
+        disable_nagle(self.client_socket)
         self.client_socket.connect(server_address)
         self.game = Game()
+        self.sent_tick = None
+        self.reader = FrameReader()
+        self.lock = threading.Lock()
 
-        data = self.client_socket.recv(BUFFER_SIZE)
-        message = pickle.loads(data)
+        data = recv_msg(self.client_socket)
+        message = decoder.decode(data)
         self.handle_message(message)
 
         pygame.init()
         screen_size = (800, 600)
 
         self.clock = pygame.time.Clock()
-        self.display = pygame.display.set_mode(screen_size)
+        self.caption_timer = Timer(start=True)
+        self.display = pygame.display.set_mode(
+            screen_size, pygame.DOUBLEBUF | pygame.HWSURFACE)
         pygame.display.set_caption('2D Multiplayer Test')
 
         self.done = False
@@ -411,30 +921,52 @@ class GameClient:
 
     def listen_to_server(self):
         while not self.done:
-            data = self.client_socket.recv(BUFFER_SIZE)
-
-            if data:
-                message = pickle.loads(data)
-                self.handle_message(message)
+            for message in self.reader.read(self.client_socket):
+                with self.lock:
+                    self.handle_message(message)
 
     def handle_message(self, message):
-        if message.type == MessageType.NEW_PLAYER_INFO:
-            player_info = message.data
-            self.player = Player(player_info['id'])
-            self.player.load_info(player_info)
-            self.player.state = PlayerState.CURRENT
-            self.game.players.append(self.player)
-        elif message.type == MessageType.GAME_INFO_SEND:
-            player_info = self.player.dump_info()
-            if player_info['state'] == PlayerState.CURRENT:
-                player_info['state'] = PlayerState.ONLINE
-            game_info = message.data
-            self.game.load_info(game_info)
-            if player_info['state'] == PlayerState.ONLINE:
-                player_info['state'] = PlayerState.CURRENT
-            self.player.load_info(player_info)
+        handler = self._handlers.get(message.type)
+        if handler is not None:
+            handler(message.data)
+
+    def _on_new_player_info(self, player_info):
+        self.player = Player(player_info.id)
+        self.player.load_info(player_info)
+        self.player.state = PlayerState.CURRENT
+        self.game.players.add(self.player)
+        self.game.local_player = self.player
+
+    def _on_game_info_send(self, game_info):
+        # The server owns the game state, only the local player's movement
+        # is predicted here and kept over what the server last saw. When the
+        # server kills the player its velocity carries the knockback, so
+        # that one is taken over
+        was_dead = self.player.state == PlayerState.DEAD
+        player_info = self.player.dump_info()
+        self.game.load_info(game_info)
+        if self.player.state == PlayerState.DEAD:
+            player_info.state = PlayerState.DEAD
+            if not was_dead:
+                player_info.velocity = None
+        else:
+            player_info.state = PlayerState.CURRENT
+        self.player.load_info(player_info)
+
+    def predict(self):
+        self.player.position += self.player.velocity
+        self.player.velocity *= Player.damping
+        # Let the velocity settle at zero instead of changing, and being
+        # sent, in ever smaller steps
+        velocity = self.player.velocity
+        velocity[np.abs(velocity) < MIN_SPEED] = 0
+        self.player.update(self.game)
+
+        self.game.tick += 1
+        self.game.players.mark_changes(self.game.tick)
 
     def loop(self):
+        next_tick = time.perf_counter() + TICK_INTERVAL
         while not self.done:
             mouse = pygame.mouse.get_pos()
             for event in pygame.event.get():
@@ -442,22 +974,46 @@ class GameClient:
                     self.done = True
                 self.player.control(event)
 
-            #self.game.draw(self.display,
-            #               self.player.rect.center + self.player.position)
-            self.game.draw(self.display, pygame.math.Vector2(0, 0))
-
-            self.game.update()
-
-            if self.player.state != PlayerState.DEAD:
-                self.player.turn_to(mouse)
-            
-            pygame.display.update()
-
-            self.clock.tick(60)
-
-            message = Message(MessageType.PLAYER_INFO, self.player.dump_info())
-            data = pickle.dumps(message)
-            self.client_socket.sendall(data)
+            with self.lock:
+                #self.game.draw(self.display,
+                #               self.player.rect.center + self.player.position)
+                self.game.draw(self.display, (0, 0))
+
+                self.predict()
+
+                if self.player.state != PlayerState.DEAD:
+                    self.player.turn_to(mouse)
+
+            pygame.display.flip()
+
+            # The clock only measures the frame rate, pacing is done against
+            # absolute deadlines so frame jitter does not accumulate
+            self.clock.tick()
+            self.caption_timer.update()
+            if self.caption_timer.time_elapsed > 1:
+                self.caption_timer.reset()
+                pygame.display.set_caption('2D Multiplayer Test ({:.0f} FPS)'
+                                           .format(self.clock.get_fps()))
+            delay = next_tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+                next_tick += TICK_INTERVAL
+            else:
+                next_tick = time.perf_counter() + TICK_INTERVAL
+
+            with self.lock:
+                player_info = None
+                if self.player.changed_since(self.sent_tick):
+                    player_info = self.player.dump_info(since=self.sent_tick)
+                    self.sent_tick = self.game.tick
+                    # The server owns the state, so it is never sent
+                    player_info.state = None
+
+            if player_info is not None and \
+                    player_info != PlayerInfo(id=player_info.id):
+                message = MessageEnv(MessageType.PLAYER_INFO, player_info)
+                data = encoder.encode(message)
+                send_msg(self.client_socket, data)
 
         pygame.quit()
 